@@ -1,122 +1,153 @@
-import requests
+import asyncio
+import httpx
+import orjson
+import random
+from websockets.asyncio.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake, InvalidStatus
 import time
 import hmac
 import hashlib
+import ssl
 import sys
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional, Dict, Any
-from enum import Enum
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 class Config:
     DEVICE_ID = "sunshade-01"
     PSK = b"secretkey"
     SERVER_URL = "http://localhost:5138"
-    POLL_TIMEOUT = 5
     RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 30
+    REQUEST_TIMEOUT = 5
+    STABLE_CHANNEL_TIME = 60
+    TOKEN_TTL = 300
+    WS_OPEN_TIMEOUT = 5
+    WS_PING_INTERVAL = 20
+    WS_PING_TIMEOUT = 10
 
-class DeviceAction(Enum):
-    OPEN = "open"
-    CLOSE = "close"
+# Action name -> (servo angle, status log message); one dict lookup per message
+_ACTIONS = {
+    "open": (180, "Status: opened"),
+    "close": (0, "Status: closed"),
+}
 
 @dataclass
 class AuthToken:
     token: str
-    channel_id: Optional[str] = None
+    expires_at: float = 0.0
+    # Built once per token so the hot path never allocates a header dict
+    headers: Dict[str, str] = field(default_factory=dict)
 
 class DeviceAPIError(Exception):
     """Custom exception for device API related errors"""
-    pass
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
 
 class DeviceController:
+    def __init__(self):
+        self._servo = None
+
     def set_angle(self, angle: int) -> None:
-        """
-        Control the device servo motor angle
-        Currently stubbed out for demonstration
-        """
-        logger.info(f"Setting servo angle to {angle}")
-        # Actual servo control implementation would go here
-        pass
+        """Control the device servo motor angle"""
+        logger.info("Setting servo angle to %d", angle)
+        try:
+            if self._servo is None:
+                # Deferred so importing this module doesn't pull in RPi.GPIO
+                # and configure the hardware until the first actual command
+                import servo_control
+                self._servo = servo_control
+            self._servo.set_angle(angle)
+        except (ImportError, RuntimeError) as e:
+            # A GPIO hiccup must not take down the listener loop
+            logger.error("Servo command failed: %s", e)
 
 class DeviceAPI:
     def __init__(self, server_url: str, device_id: str, psk: bytes):
         self.server_url = server_url
         self.device_id = device_id
         self.psk = psk
-        self.session = requests.Session()
+        # Template with the ipad/opad key schedule already absorbed;
+        # per-challenge signing just copies the inner state
+        self._hmac_template = hmac.new(psk, digestmod=hashlib.sha256)
+        # Single HTTP/2 client: auth requests multiplex on one connection
+        # and HPACK compresses the repeated headers
+        self.client = httpx.AsyncClient(
+            base_url=server_url,
+            http2=True,
+            timeout=Config.REQUEST_TIMEOUT,
+            headers={"Content-Type": "application/json"}
+        )
+        # Request paths built once instead of per call
+        self._paths = {
+            ep: f"/api/{ep}" for ep in ("deviceauth/challenge", "deviceauth/respond")
+        }
+        self.ws_url = server_url.replace("http", "ws", 1) + "/api/channel/listener"
 
-    def _make_request(self, endpoint: str, method: str = "POST", allow_timeout: bool = False, **kwargs) -> Dict[str, Any]:
+    async def _make_request(self, path: str, method: str = "POST", payload: Optional[Dict[str, Any]] = None,
+                            headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
         """Helper method to make HTTP requests with error handling"""
         try:
-            url = f"{self.server_url}/api/{endpoint}"
-            response = self.session.request(method, url, **kwargs)
-            
+            body = orjson.dumps(payload) if payload is not None else None
+            response = await self.client.request(method, path, content=body, headers=headers)
+
             # Check for non-200 status codes
             if response.status_code != 200:
-                raise DeviceAPIError(f"HTTP {response.status_code}: {response.text}")
-                
-            return response.json()
-            
-        except requests.exceptions.Timeout:
-            if allow_timeout:
-                raise  # Re-raise the Timeout exception if it's allowed
+                raise DeviceAPIError(
+                    f"HTTP {response.status_code}: {response.text}",
+                    status=response.status_code
+                )
+
+            return orjson.loads(response.content)
+
+        except httpx.TimeoutException:
             raise DeviceAPIError("Request timed out")
-            
-        except requests.exceptions.RequestException as e:
+
+        except httpx.HTTPError as e:
             raise DeviceAPIError(f"API request failed: {e}")
 
-    def get_challenge(self) -> str:
+    async def get_challenge(self) -> str:
         """Request authentication challenge from server"""
-        response = self._make_request(
-            "deviceauth/challenge",
-            json={"Serial": self.device_id}
+        response = await self._make_request(
+            self._paths["deviceauth/challenge"],
+            payload={"Serial": self.device_id}
         )
         return response["challenge"]
 
-    def submit_challenge_response(self, challenge: str) -> str:
+    async def submit_challenge_response(self, challenge: str) -> str:
         """Submit challenge response and get auth token"""
-        signature = hmac.new(self.psk, challenge.encode(), hashlib.sha256).hexdigest()
-        response = self._make_request(
-            "deviceauth/respond",
-            json={
+        h = self._hmac_template.copy()
+        h.update(challenge.encode())
+        signature = h.hexdigest()
+        response = await self._make_request(
+            self._paths["deviceauth/respond"],
+            payload={
                 "Serial": self.device_id,
                 "challengeResponse": signature
             }
         )
         return response["token"]
 
-    def get_channel_id(self, token: str) -> str:
-        """Get channel ID for long polling"""
-        response = self._make_request(
-            "channel/listener/connect",
-            headers={"Authorization": token}
-        )
-        return response["channelId"]
-
-    def poll_channel(self, token: str, channel_id: str) -> Optional[str]:
-        """Poll for new messages"""
+    async def open_channel(self, auth: AuthToken):
+        """Open the persistent WebSocket listener channel"""
         try:
-            response = self._make_request(
-                "channel/listener/poll",
-                headers={"Authorization": token},
-                json={"channelId": channel_id},
-                timeout=Config.POLL_TIMEOUT,
-                allow_timeout=True  # Allow timeout exceptions to propagate
+            return await ws_connect(
+                self.ws_url,
+                additional_headers=auth.headers,
+                open_timeout=Config.WS_OPEN_TIMEOUT,
+                ping_interval=Config.WS_PING_INTERVAL,
+                ping_timeout=Config.WS_PING_TIMEOUT
             )
-            return response.get("message")
-        except requests.exceptions.Timeout:
-            logger.debug("Poll timeout (expected)")
-            return None
-        except DeviceAPIError as e:
-            # Re-raise other API errors
-            raise
+        except InvalidStatus as e:
+            raise DeviceAPIError(
+                f"Channel rejected with HTTP {e.response.status_code}",
+                status=e.response.status_code
+            )
+        except (OSError, InvalidHandshake) as e:
+            raise DeviceAPIError(f"Channel connect failed: {e}")
 
 class DeviceManager:
     def __init__(self):
@@ -124,62 +155,111 @@ class DeviceManager:
         self.controller = DeviceController()
         self.auth_token: Optional[AuthToken] = None
 
-    def authenticate(self) -> bool:
+    async def authenticate(self) -> bool:
         """Perform device authentication"""
         try:
-            challenge = self.api.get_challenge()
-            token = self.api.submit_challenge_response(challenge)
-            channel_id = self.api.get_channel_id(token)
-            self.auth_token = AuthToken(token=token, channel_id=channel_id)
+            challenge = await self.api.get_challenge()
+            token = await self.api.submit_challenge_response(challenge)
+            self.auth_token = AuthToken(
+                token=token,
+                expires_at=time.monotonic() + Config.TOKEN_TTL,
+                headers={"Authorization": token}
+            )
             logger.info("Authentication successful")
             return True
         except DeviceAPIError as e:
-            logger.error(f"Authentication failed: {e}")
+            logger.error("Authentication failed: %s", e)
             return False
 
+    async def _ensure_token(self) -> None:
+        """Refresh the cached token only when it is missing or about to expire"""
+        if self.auth_token and time.monotonic() < self.auth_token.expires_at - 5:
+            return
+        if not await self.authenticate():
+            raise DeviceAPIError("Token refresh failed")
+
     def handle_action(self, action: str) -> None:
         """Handle received device actions"""
-        try:
-            device_action = DeviceAction(action)
-            if device_action == DeviceAction.CLOSE:
-                self.controller.set_angle(0)
-                logger.info("Status: closed")
-            elif device_action == DeviceAction.OPEN:
-                self.controller.set_angle(180)
-                logger.info("Status: opened")
-        except ValueError:
-            logger.error(f"Unknown action received: {action}")
+        entry = _ACTIONS.get(action)
+        if entry is None:
+            logger.error("Unknown action received: %s", action)
+            return
+        angle, status = entry
+        self.controller.set_angle(angle)
+        logger.info(status)
 
     def run(self) -> None:
+        """Synchronous entry point"""
+        asyncio.run(self.run_async())
+
+    async def run_async(self) -> None:
         """Main run loop"""
-        if not self.authenticate():
+        if not await self.authenticate():
             logger.error("Initial authentication failed")
             sys.exit(1)
-        #Debug
-        print(f"Auth: {self.auth_token.token}")
-        print(f"ChannelId: {self.auth_token.channel_id}")
-        
+
+        # One coroutine per control channel; further channels just become
+        # extra tasks in the gather
+        await asyncio.gather(self._listen())
+
+    async def _listen(self) -> None:
+        """Service the listener channel, reconnecting with backoff"""
+        backoff = Config.RETRY_DELAY
+        reauthed = False
         while True:
             try:
-                if not self.auth_token or not self.auth_token.channel_id:
-                    raise DeviceAPIError("Missing authentication token or channel ID")
+                await self._ensure_token()
 
-                message = self.api.poll_channel(
-                    self.auth_token.token,
-                    self.auth_token.channel_id
-                )
-                
-                if message:
-                    self.handle_action(message)
-                    
-                time.sleep(Config.RETRY_DELAY)
+                channel = await self.api.open_channel(self.auth_token)
+                connected_at = time.monotonic()
+                try:
+                    async for message in channel:
+                        # Messages flowing prove the channel is healthy
+                        backoff = Config.RETRY_DELAY
+                        reauthed = False
+                        try:
+                            action = orjson.loads(message)["action"]
+                            if not isinstance(action, str):
+                                raise TypeError("action is not a string")
+                        except (ValueError, KeyError, TypeError):
+                            logger.error("Malformed channel message: %r", message)
+                            continue
+                        self.handle_action(action)
+                finally:
+                    # An idle channel that stayed open long enough also counts
+                    # as healthy, so benign drops (NAT resets, deploys) don't
+                    # ratchet the delay to the max and keep it there
+                    if time.monotonic() - connected_at >= Config.STABLE_CHANNEL_TIME:
+                        backoff = Config.RETRY_DELAY
+                        reauthed = False
+                    await channel.close()
+                logger.warning("Channel closed by server, reconnecting")
+                await asyncio.sleep(backoff + random.uniform(0, 0.5))
+                backoff = min(backoff * 2, Config.MAX_RETRY_DELAY)
 
+            except ConnectionClosed:
+                logger.warning("Channel connection lost, reconnecting")
+                await asyncio.sleep(backoff + random.uniform(0, 0.5))
+                backoff = min(backoff * 2, Config.MAX_RETRY_DELAY)
             except DeviceAPIError as e:
-                logger.error(f"Fatal error: {e}")
-                sys.exit(1)
+                if e.status == 401:
+                    logger.warning("Token rejected by server, re-authenticating")
+                    self.auth_token = None
+                    if not reauthed:
+                        # One immediate retry; repeated rejections back off below
+                        reauthed = True
+                        continue
+                else:
+                    logger.error("API error: %s", e)
+                await asyncio.sleep(backoff + random.uniform(0, 0.5))
+                backoff = min(backoff * 2, Config.MAX_RETRY_DELAY)
 
 def main():
     try:
+        if "sha256" not in hashlib.algorithms_available:
+            logger.error("OpenSSL build is missing SHA-256 support")
+            sys.exit(1)
+        logger.info("Using %s", ssl.OPENSSL_VERSION)
         device_manager = DeviceManager()
         device_manager.run()
     except KeyboardInterrupt:
@@ -187,4 +267,10 @@ def main():
         sys.exit(0)
 
 if __name__ == "__main__":
+    # Configure logging only when run as the entry point, so importing
+    # this module doesn't pay the config cost
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
     main()
\ No newline at end of file
@@ -1,5 +1,5 @@
 import RPi.GPIO as GPIO
-import time
+import threading
 
 SERVO_PIN = 1
 GPIO.setmode(GPIO.BCM)
@@ -7,10 +7,32 @@ GPIO.setup(SERVO_PIN, GPIO.OUT)
 servo = GPIO.PWM(SERVO_PIN, 50)
 servo.start(0)
 
+SETTLE_TIME = 0.5
+
+_lock = threading.RLock()
+_settle_timer = None
+
+def _stop_pulse(timer):
+    with _lock:
+        # A stale timer can fire past its cancel() if it was already
+        # blocked on the lock; only the current settle window may stop
+        # the pulse
+        if timer is not _settle_timer:
+            return
+        GPIO.output(SERVO_PIN, False)
+        servo.ChangeDutyCycle(0)
+
 def set_angle(angle):
+    global _settle_timer
     duty_cycle = 2 + (angle / 18)
-    GPIO.output(SERVO_PIN, True)
-    servo.ChangeDutyCycle(duty_cycle)
-    time.sleep(0.5)
-    GPIO.output(SERVO_PIN, False)
-    servo.ChangeDutyCycle(0)
\ No newline at end of file
+    with _lock:
+        # Rapid successive commands coalesce: cancel the pending stop and
+        # let the latest angle own the settle window
+        if _settle_timer is not None:
+            _settle_timer.cancel()
+        GPIO.output(SERVO_PIN, True)
+        servo.ChangeDutyCycle(duty_cycle)
+        timer = threading.Timer(SETTLE_TIME, lambda: _stop_pulse(timer))
+        timer.daemon = True
+        _settle_timer = timer
+        timer.start()